@@ -3,11 +3,60 @@ API连接器模块，用于与DeepSeek-Chat API交互
 """
 
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import time
-from typing import Dict, Any, Optional, Union
+import random
+import asyncio
+import hashlib
+import threading
+from itertools import islice
+from collections import OrderedDict
+from typing import Dict, Any, Iterator, List, Optional, Union
 import config
 
+try:
+    import httpx
+except ImportError:  # 异步调用为可选功能，未安装httpx时仅支持同步调用
+    httpx = None
+
+try:
+    import orjson
+except ImportError:  # 未安装orjson时回退到标准库json
+    orjson = None
+
+
+def _body_kwargs(payload: Dict[str, Any], data_key: str = "data") -> Dict[str, Any]:
+    """
+    构建请求体参数
+    
+    有orjson时直接传入序列化好的字节串，否则交给HTTP库的json参数序列化，
+    避免先dumps成字符串再编码为字节的多余转换。
+    
+    Args:
+        payload: 请求负载
+        data_key: 原始字节请求体对应的参数名，requests为data，httpx为content
+    """
+    if orjson is not None:
+        return {data_key: orjson.dumps(payload)}
+    return {"json": payload}
+
+
+def _json_loads(data: Union[bytes, str]) -> Any:
+    """
+    解析响应体，安装了orjson时优先使用
+    
+    orjson不接受NaN等标准库能解析的写法，失败时交给标准库再试一次，结果与只用标准库时一致。
+    orjson.JSONDecodeError是json.JSONDecodeError的子类，调用方只需捕获后者。
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(data)
+
+
 class APIError(Exception):
     """API调用错误"""
     pass
@@ -20,9 +69,21 @@ class RateLimitError(APIError):
     """速率限制错误"""
     pass
 
+# 重试可能成功的HTTP状态码，其余错误状态立即失败
+_RETRYABLE_STATUS = frozenset({408, 425, 429, 500, 502, 503, 504})
+
 class AIModelConnector:
     """DeepSeek-Chat API连接器"""
     
+    # 固定的系统提示词消息和响应格式，所有请求共用
+    _SYSTEM_MSG = {"role": "system", "content": "请以有效的JSON格式输出响应，不要添加任何额外的文本、解释或前缀/后缀。确保JSON格式正确，可以被JSON解析器直接解析。"}
+    _JSON_RESPONSE_FORMAT = {"type": "json_object"}
+    
+    # 低温度调用的响应缓存，所有连接器实例共享，按最近使用顺序淘汰
+    _response_cache: "OrderedDict[tuple, str]" = OrderedDict()
+    # 缓存在所有实例和线程间共享，读写都需要加锁
+    _cache_lock = threading.Lock()
+    
     def __init__(
         self, 
         api_key: Optional[str] = None,
@@ -42,11 +103,68 @@ class AIModelConnector:
         if not self.api_key:
             raise AuthenticationError("DeepSeek API密钥未设置")
         
+        # 请求头在连接器生命周期内不变，只构建一次
+        self._headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.api_key}"
+        }
+        
         # 设置模型名称
         self.model_name = model_name if model_name else config.DEFAULT_DEEPSEEK_MODEL
         
         # 设置API端点
         self.api_endpoint = config.DEEPSEEK_API_ENDPOINT
+        
+        # 创建持久会话，复用连接池中的keep-alive连接，避免每次调用重新握手
+        self._session = requests.Session()
+        self._session.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=20))
+        self._session.headers.update(self._headers)
+        
+        # 异步客户端与并发限制信号量在首次异步调用时再创建（需绑定到当前事件循环）
+        self._aclient = None
+        self._semaphore = None
+    
+    def close(self) -> None:
+        """
+        关闭会话并释放连接池
+        """
+        self._session.close()
+    
+    async def aclose(self) -> None:
+        """
+        关闭异步客户端并释放连接池
+        """
+        if self._aclient is not None:
+            await self._aclient.aclose()
+            self._aclient = None
+        self._semaphore = None
+    
+    def _get_async_client(self) -> "httpx.AsyncClient":
+        """
+        获取共享的异步HTTP客户端，首次调用时创建
+        
+        Returns:
+            httpx.AsyncClient实例
+            
+        Raises:
+            APIError: 未安装httpx时抛出
+        """
+        if httpx is None:
+            raise APIError("异步调用需要安装httpx: pip install httpx")
+        
+        if self._aclient is None:
+            self._aclient = httpx.AsyncClient(
+                headers=self._headers,
+                timeout=config.API_TIMEOUT,
+                limits=httpx.Limits(max_connections=20, max_keepalive_connections=10)
+            )
+        return self._aclient
+    
+    def __enter__(self) -> "AIModelConnector":
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
     
     def _prepare_headers(self) -> Dict[str, str]:
         """
@@ -55,12 +173,7 @@ class AIModelConnector:
         Returns:
             请求头字典
         """
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.api_key}"
-        }
-        
-        return headers
+        return self._headers
     
     def _prepare_payload(self, prompt: str, **kwargs) -> Dict[str, Any]:
         """
@@ -75,13 +188,10 @@ class AIModelConnector:
         """
         payload = {
             "model": self.model_name,
-            "messages": [
-                {"role": "system", "content": "请以有效的JSON格式输出响应，不要添加任何额外的文本、解释或前缀/后缀。确保JSON格式正确，可以被JSON解析器直接解析。"},
-                {"role": "user", "content": prompt}
-            ],
+            "messages": [self._SYSTEM_MSG, {"role": "user", "content": prompt}],
             "temperature": kwargs.get("temperature", 0.7),
             "max_tokens": kwargs.get("max_tokens", 1000),
-            "response_format": {"type": "json_object"}  # 如果模型支持，指定JSON响应格式
+            "response_format": self._JSON_RESPONSE_FORMAT  # 如果模型支持，指定JSON响应格式
         }
         
         # 添加其他特定模型的参数
@@ -90,6 +200,334 @@ class AIModelConnector:
         
         return payload
     
+    def _backoff_delay(self, retries: int, headers: Optional[Dict[str, str]] = None) -> float:
+        """
+        计算下一次重试前的等待时间
+        
+        优先使用服务端返回的Retry-After头，否则使用带随机抖动的指数退避，
+        避免多个客户端在速率限制后同步重试。
+        
+        Args:
+            retries: 已重试的次数
+            headers: 可选，响应头
+            
+        Returns:
+            等待秒数
+        """
+        retry_after = headers.get("Retry-After") if headers else None
+        if retry_after:
+            try:
+                return max(0.0, float(retry_after))
+            except ValueError:
+                pass  # HTTP日期格式的Retry-After按指数退避处理
+        
+        delay = min(config.RETRY_MAX_DELAY, config.RETRY_DELAY * (2 ** retries))
+        return delay * random.uniform(0.5, 1.5)
+    
+    def _cache_key(self, prompt: str, **kwargs) -> Optional[tuple]:
+        """
+        计算响应缓存键
+        
+        只有非流式且温度不高于CACHE_MAX_TEMPERATURE的调用结果可复现，才会被缓存，
+        温度为None（由服务端决定）时不缓存。
+        提示词以摘要形式参与键计算，避免长提示词占用过多内存。
+        
+        Args:
+            prompt: 提示词
+            **kwargs: 调用参数
+            
+        Returns:
+            缓存键，不可缓存时返回None
+        """
+        temperature = kwargs.get("temperature", 0.7)
+        if kwargs.get("stream", False) or temperature is None or temperature > config.CACHE_MAX_TEMPERATURE:
+            return None
+        
+        digest = hashlib.blake2b(prompt.encode("utf-8"), digest_size=16).hexdigest()
+        return (self.api_endpoint, self.model_name, digest, temperature, kwargs.get("max_tokens", 1000))
+    
+    def _cache_response(self, key: Optional[tuple], content: str) -> None:
+        """
+        写入响应缓存，超出容量时淘汰最久未使用的条目
+        
+        Args:
+            key: 缓存键，为None时不缓存
+            content: 模型响应文本
+        """
+        if key is None:
+            return
+        cache = self._response_cache
+        with self._cache_lock:
+            cache[key] = content
+            cache.move_to_end(key)
+            while len(cache) > config.RESPONSE_CACHE_SIZE:
+                cache.popitem(last=False)
+    
+    def _get_cached_response(self, key: Optional[tuple]) -> Optional[str]:
+        """
+        读取响应缓存
+        
+        Args:
+            key: 缓存键
+            
+        Returns:
+            缓存的响应文本，未命中时返回None
+        """
+        if key is None:
+            return None
+        with self._cache_lock:
+            content = self._response_cache.get(key)
+            if content is not None:
+                self._response_cache.move_to_end(key)
+            return content
+    
+    @classmethod
+    def clear_cache(cls) -> int:
+        """
+        清除响应缓存
+        
+        Returns:
+            清除的缓存条目数量
+        """
+        with cls._cache_lock:
+            count = len(cls._response_cache)
+            cls._response_cache.clear()
+        return count
+    
+    def _status_error(self, status_code: int, body: bytes) -> APIError:
+        """
+        根据错误状态码和响应体构建对应的异常
+        
+        Args:
+            status_code: HTTP状态码
+            body: 响应体
+            
+        Returns:
+            对应的异常实例
+        """
+        if status_code == 401:
+            return AuthenticationError("API密钥无效或已过期")
+        if status_code == 429:
+            return RateLimitError("API速率限制，请稍后再试")
+        
+        error_msg = f"API调用失败，状态码: {status_code}"
+        try:
+            error_data = _json_loads(body)
+            error_msg += f", 错误: {error_data.get('error', {}).get('message', '未知错误')}"
+        except Exception:
+            if body:
+                error_msg += f", 响应: {body[:200].decode('utf-8', 'replace')}"
+        return APIError(error_msg)
+    
+    def _deadline(self, **kwargs) -> float:
+        """
+        计算本次调用的截止时间
+        
+        Args:
+            **kwargs: 调用参数，可通过total_timeout指定总时间预算（秒）
+            
+        Returns:
+            基于time.monotonic()的截止时间
+        """
+        total_timeout = kwargs.get("total_timeout", config.API_TIMEOUT * (config.MAX_RETRIES + 1))
+        return time.monotonic() + total_timeout
+    
+    def _remaining_budget(self, deadline: float, last_error: Optional[APIError]) -> float:
+        """
+        计算剩余的时间预算
+        
+        Args:
+            deadline: 截止时间
+            last_error: 上一次失败对应的异常
+            
+        Returns:
+            剩余秒数
+            
+        Raises:
+            APIError: 时间预算已用尽时抛出上一次失败的异常（保留状态码和错误类型），
+                      还没有失败过时抛出普通APIError
+        """
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            if last_error is not None:
+                raise last_error
+            raise APIError("API调用超出总时间预算")
+        return remaining
+    
+    def _request_timeout(self, deadline: float, last_error: Optional[APIError] = None) -> float:
+        """
+        计算单次请求的超时时间，不超过剩余的时间预算
+        
+        Args:
+            deadline: 截止时间
+            last_error: 上一次失败对应的异常
+            
+        Returns:
+            本次请求的超时秒数
+        """
+        return min(config.API_TIMEOUT, self._remaining_budget(deadline, last_error))
+    
+    def _sleep_within(self, deadline: float, delay: float, last_error: APIError) -> float:
+        """
+        检查重试等待时间是否还在剩余的时间预算内
+        
+        Args:
+            deadline: 截止时间
+            delay: 期望的等待秒数
+            last_error: 本次失败对应的异常，预算不够等待时抛出
+            
+        Returns:
+            应等待的秒数
+            
+        Raises:
+            APIError: 等待结束时预算已经用尽，没有机会再发请求，直接抛出last_error
+        """
+        if delay >= self._remaining_budget(deadline, last_error):
+            raise last_error
+        return delay
+    
+    def _extract_content(self, body: bytes) -> str:
+        """
+        从chat/completions响应体中取出第一条回复的文本
+        
+        Args:
+            body: 响应体
+            
+        Returns:
+            模型响应文本
+        """
+        data = _json_loads(body)
+        return data["choices"][0]["message"]["content"]
+    
+    def _check_content_length(self, headers: Dict[str, str]) -> None:
+        """
+        根据Content-Length提前拒绝超出大小限制的响应
+        
+        Args:
+            headers: 响应头
+            
+        Raises:
+            APIError: 响应体超出MAX_RESPONSE_BYTES时抛出
+        """
+        length = headers.get("Content-Length")
+        if not length:
+            return
+        try:
+            length = int(length)
+        except ValueError:
+            raise APIError(f"API响应的Content-Length无效: {length}")
+        if length > config.MAX_RESPONSE_BYTES:
+            raise APIError(f"API响应过大: {length}字节，上限{config.MAX_RESPONSE_BYTES}字节")
+    
+    def _read_body(self, response: requests.Response) -> bytes:
+        """
+        分块读取响应体，超出大小限制时立即中止
+        
+        Args:
+            response: 以stream=True发起请求得到的响应
+            
+        Returns:
+            响应体字节串
+            
+        Raises:
+            APIError: 响应体超出MAX_RESPONSE_BYTES时抛出
+        """
+        self._check_content_length(response.headers)
+        buffer = bytearray()
+        for chunk in response.iter_content(chunk_size=8192):
+            buffer += chunk
+            if len(buffer) > config.MAX_RESPONSE_BYTES:
+                raise APIError(f"API响应超过{config.MAX_RESPONSE_BYTES}字节，已中止读取")
+        return bytes(buffer)
+    
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        """
+        获取限制并发请求数的信号量，首次调用时创建
+        
+        Returns:
+            最多允许MAX_CONCURRENCY个请求同时进行的信号量
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(config.MAX_CONCURRENCY)
+        return self._semaphore
+    
+    async def _aread_body(self, response: "httpx.Response") -> bytes:
+        """
+        异步分块读取响应体，超出大小限制时立即中止
+        
+        Args:
+            response: 以stream=True发送请求得到的响应
+            
+        Returns:
+            响应体字节串
+            
+        Raises:
+            APIError: 响应体超出MAX_RESPONSE_BYTES时抛出
+        """
+        self._check_content_length(response.headers)
+        buffer = bytearray()
+        async for chunk in response.aiter_bytes():
+            buffer += chunk
+            if len(buffer) > config.MAX_RESPONSE_BYTES:
+                raise APIError(f"API响应超过{config.MAX_RESPONSE_BYTES}字节，已中止读取")
+        return bytes(buffer)
+    
+    def stream_api(self, prompt: str, **kwargs) -> Iterator[str]:
+        """
+        以流式方式调用DeepSeek API，逐块返回生成的文本
+        
+        流式调用不做重试，也不经过响应缓存。
+        
+        Args:
+            prompt: 提示词
+            **kwargs: 其他参数，如温度、最大标记数等
+            
+        Yields:
+            模型依次生成的文本片段
+            
+        Raises:
+            APIError: API调用错误
+            AuthenticationError: 认证错误
+            RateLimitError: 速率限制错误
+        """
+        kwargs["stream"] = True
+        payload = self._prepare_payload(prompt, **kwargs)
+        
+        try:
+            response = self._session.post(
+                self.api_endpoint,
+                **_body_kwargs(payload),
+                timeout=config.API_TIMEOUT,
+                stream=True
+            )
+        except requests.exceptions.RequestException as e:
+            raise APIError(f"API请求异常: {str(e)}")
+        
+        try:
+            if response.status_code != 200:
+                raise self._status_error(response.status_code, self._read_body(response))
+            
+            # 解析SSE数据行: "data: {...}"，以"data: [DONE]"结束
+            received = 0
+            for line in response.iter_lines():
+                received += len(line)
+                if received > config.MAX_RESPONSE_BYTES:
+                    raise APIError(f"API响应超过{config.MAX_RESPONSE_BYTES}字节，已中止读取")
+                if not line.startswith(b"data:"):
+                    continue
+                data = line[5:].strip()
+                if data == b"[DONE]":
+                    break
+                chunk = _json_loads(data)
+                choices = chunk.get("choices") or [{}]
+                delta = choices[0].get("delta", {}).get("content")
+                if delta:
+                    yield delta
+        except (requests.exceptions.RequestException, json.JSONDecodeError) as e:
+            raise APIError(f"API流式响应异常: {str(e)}")
+        finally:
+            response.close()
+    
     def call_api(self, prompt: str, **kwargs) -> str:
         """
         调用DeepSeek API
@@ -106,51 +544,190 @@ class AIModelConnector:
             AuthenticationError: 认证错误
             RateLimitError: 速率限制错误
         """
-        headers = self._prepare_headers()
+        # 流式调用逐块读取，拼接为完整文本
+        if kwargs.get("stream", False):
+            return "".join(self.stream_api(prompt, **kwargs))
+        
+        cache_key = self._cache_key(prompt, **kwargs)
+        cached = self._get_cached_response(cache_key)
+        if cached is not None:
+            return cached
+        
         payload = self._prepare_payload(prompt, **kwargs)
         
-        # 重试逻辑
+        # 重试逻辑，所有尝试与等待共享同一个总时间预算
+        deadline = self._deadline(**kwargs)
+        last_error = None
         retries = 0
         while retries <= config.MAX_RETRIES:
             try:
-                response = requests.post(
+                response = self._session.post(
                     self.api_endpoint,
-                    headers=headers,
-                    data=json.dumps(payload),
-                    timeout=config.API_TIMEOUT
+                    **_body_kwargs(payload),
+                    timeout=self._request_timeout(deadline, last_error),
+                    stream=True
                 )
+                try:
+                    body = self._read_body(response)
+                finally:
+                    response.close()
                 
                 # 检查响应状态
                 if response.status_code == 200:
-                    data = response.json()
-                    return data["choices"][0]["message"]["content"]
+                    content = self._extract_content(body)
+                    self._cache_response(cache_key, content)
+                    return content
                 
-                # 处理错误
-                elif response.status_code == 401:
-                    raise AuthenticationError("API密钥无效或已过期")
-                elif response.status_code == 429:
-                    if retries < config.MAX_RETRIES:
-                        retries += 1
-                        time.sleep(config.RETRY_DELAY)
-                        continue
-                    else:
-                        raise RateLimitError("API速率限制，请稍后再试")
+                # 可重试的状态码（速率限制、超时、服务端错误）退避后重试
+                elif response.status_code in _RETRYABLE_STATUS and retries < config.MAX_RETRIES:
+                    last_error = self._status_error(response.status_code, body)
+                    time.sleep(self._sleep_within(deadline, self._backoff_delay(retries, response.headers), last_error))
+                    retries += 1
+                    continue
+                
+                # 其他错误重试也不会成功，立即失败
                 else:
-                    error_msg = f"API调用失败，状态码: {response.status_code}"
-                    try:
-                        error_data = response.json()
-                        error_msg += f", 错误: {error_data.get('error', {}).get('message', '未知错误')}"
-                    except:
-                        pass
-                    raise APIError(error_msg)
+                    raise self._status_error(response.status_code, body)
             
             except (requests.exceptions.RequestException, json.JSONDecodeError) as e:
+                last_error = APIError(f"API请求异常: {str(e)}")
                 if retries < config.MAX_RETRIES:
+                    time.sleep(self._sleep_within(deadline, self._backoff_delay(retries), last_error))
                     retries += 1
-                    time.sleep(config.RETRY_DELAY)
                     continue
                 else:
-                    raise APIError(f"API请求异常: {str(e)}")
+                    raise last_error from e
         
         # 如果所有重试都失败
-        raise APIError("达到最大重试次数，API调用失败") 
\ No newline at end of file
+        raise APIError("达到最大重试次数，API调用失败")
+    
+    async def acall_api(self, prompt: str, **kwargs) -> str:
+        """
+        异步调用DeepSeek API
+        
+        与call_api行为一致，但使用共享的httpx.AsyncClient，
+        多个请求可以通过asyncio.gather并发执行。
+        
+        Args:
+            prompt: 提示词
+            **kwargs: 其他参数，如温度、最大标记数等
+            
+        Returns:
+            模型响应文本
+            
+        Raises:
+            APIError: API调用错误
+            AuthenticationError: 认证错误
+            RateLimitError: 速率限制错误
+            ValueError: 指定stream=True时抛出，异步调用不支持流式响应
+        """
+        # 流式响应是SSE格式，不能按JSON响应体解析，同步的stream_api才支持
+        if kwargs.get("stream", False):
+            raise ValueError("acall_api不支持流式调用，请使用stream_api")
+        
+        cache_key = self._cache_key(prompt, **kwargs)
+        cached = self._get_cached_response(cache_key)
+        if cached is not None:
+            return cached
+        
+        client = self._get_async_client()
+        payload = self._prepare_payload(prompt, **kwargs)
+        
+        # 重试逻辑，所有尝试与等待共享同一个总时间预算
+        deadline = self._deadline(**kwargs)
+        last_error = None
+        retries = 0
+        while retries <= config.MAX_RETRIES:
+            try:
+                request = client.build_request(
+                    "POST",
+                    self.api_endpoint,
+                    timeout=self._request_timeout(deadline, last_error),
+                    **_body_kwargs(payload, "content")
+                )
+                # 客户端自我限流，避免大量并发请求触发服务端速率限制
+                async with self._get_semaphore():
+                    response = await client.send(request, stream=True)
+                    try:
+                        body = await self._aread_body(response)
+                    finally:
+                        await response.aclose()
+                
+                # 检查响应状态
+                if response.status_code == 200:
+                    content = self._extract_content(body)
+                    self._cache_response(cache_key, content)
+                    return content
+                
+                # 可重试的状态码（速率限制、超时、服务端错误）退避后重试
+                elif response.status_code in _RETRYABLE_STATUS and retries < config.MAX_RETRIES:
+                    last_error = self._status_error(response.status_code, body)
+                    await asyncio.sleep(self._sleep_within(deadline, self._backoff_delay(retries, response.headers), last_error))
+                    retries += 1
+                    continue
+                
+                # 其他错误重试也不会成功，立即失败
+                else:
+                    raise self._status_error(response.status_code, body)
+            
+            except (httpx.HTTPError, json.JSONDecodeError) as e:
+                last_error = APIError(f"API请求异常: {str(e)}")
+                if retries < config.MAX_RETRIES:
+                    await asyncio.sleep(self._sleep_within(deadline, self._backoff_delay(retries), last_error))
+                    retries += 1
+                    continue
+                else:
+                    raise last_error from e
+        
+        # 如果所有重试都失败
+        raise APIError("达到最大重试次数，API调用失败")
+    
+    async def abatch(self, prompts: List[str], **kwargs) -> List[Union[str, Exception]]:
+        """
+        并发调用多个提示词
+        
+        Args:
+            prompts: 提示词列表
+            **kwargs: 传递给acall_api的其他参数
+            
+        Returns:
+            与prompts顺序一致的结果列表，失败的调用返回对应的异常对象
+        """
+        return await asyncio.gather(
+            *(self.acall_api(prompt, **kwargs) for prompt in prompts),
+            return_exceptions=True
+        )
+    
+    def call_api_many(self, prompts: List[str], batch_size: int = 4, **kwargs) -> List[Union[str, Exception]]:
+        """
+        分批并发调用多个提示词
+        
+        每批最多batch_size个请求并发执行，批与批之间顺序执行。
+        不能在已运行的事件循环中调用，异步代码请直接使用abatch。
+        
+        Args:
+            prompts: 提示词列表
+            batch_size: 每批并发的请求数量
+            **kwargs: 传递给acall_api的其他参数
+            
+        Returns:
+            与prompts顺序一致的结果列表，失败的调用返回对应的异常对象
+        """
+        if batch_size < 1:
+            raise ValueError("batch_size必须大于0")
+        
+        async def run_batches():
+            results = []
+            iterator = iter(prompts)
+            try:
+                while True:
+                    chunk = list(islice(iterator, batch_size))
+                    if not chunk:
+                        break
+                    results.extend(await self.abatch(chunk, **kwargs))
+            finally:
+                # 异步客户端绑定在本次事件循环上，结束时关闭
+                await self.aclose()
+            return results
+        
+        return asyncio.run(run_batches())
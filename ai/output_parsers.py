@@ -5,11 +5,149 @@
 import re
 import json
 import asyncio
-from typing import Dict, Any, List, Optional, Type, Union, TypeVar, Generic, Callable
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Dict, Any, Optional, Type, Union, TypeVar, Generic, Callable, Pattern, Mapping
 from abc import ABC, abstractmethod
 
+try:
+    import orjson
+except ImportError:  # 未安装orjson时回退到标准库json
+    orjson = None
+
 T = TypeVar('T')
 
+# 小于该长度的输出直接在事件循环中解析，线程池调度的开销比解析本身更大
+_INLINE_PARSE_LIMIT = 8 * 1024
+
+# 预编译的正则表达式，避免每次解析时查询re模块的内部缓存
+_CODEFENCE_OPEN_RE = re.compile(r'```(?:json|javascript|js)?\s*')
+_CODEFENCE_CLOSE_RE = re.compile(r'```\s*$')
+_JSON_START_RE = re.compile(r'[{[]')
+_BRACKET_TOKEN_RE = re.compile(r'["\\{}\[\]]')
+_DECODER = json.JSONDecoder()  # 复用解码器，raw_decode可忽略JSON之后的多余文本
+# JSON修复：缺失引号的键 | 尾部逗号 | 缺失引号的值，一次扫描完成
+_REPAIR_RE = re.compile(
+    r'(?P<key_prefix>[{,]\s*)(?P<key>[a-zA-Z0-9_]+)(?=\s*:)'
+    r'|,(?=\s*[}\]])'
+    r'|:\s*(?P<value>[a-zA-Z0-9_]+)(?=\s*[,}])'
+)
+_KV_DEFAULT_PATTERN = r'["\']?([^"\'=:]+)["\']?\s*[=:]\s*["\']?([^"\',}\]]*)["\']?[,}]?'
+# 值类型识别：整数 | 数字 | 布尔值 | 空值，一次匹配完成，配合fullmatch使用
+_VALUE_TYPE_RE = re.compile(
+    r'(?P<int>\d+)|(?P<float>-?\d+(?:\.\d+)?)'
+    r'|(?P<true>true|yes)|(?P<false>false|no)|(?P<null>none|null)',
+    re.IGNORECASE
+)
+_VALUE_CONVERTERS: Dict[str, Callable[[str], Any]] = {
+    'int': int,
+    'float': float,
+    'true': lambda _: True,
+    'false': lambda _: False,
+    'null': lambda _: None,
+}
+_LOOKS_LIKE_KV_RE = re.compile(r'[a-zA-Z_]+\s*[=:]\s*["\']?[^"\']*["\']?')
+
+def _extract_balanced(text: str, open_ch: str, close_ch: str) -> Optional[str]:
+    """
+    单次扫描提取最靠前的括号平衡片段，跳过JSON字符串中的括号
+    
+    Args:
+        text: 待扫描的文本
+        open_ch: 开始括号，如'{'
+        close_ch: 结束括号，如'}'
+        
+    Returns:
+        从开始括号到匹配的结束括号的文本，如果未找到则返回None
+    """
+    start = text.find(open_ch)
+    if start == -1:
+        return None
+    
+    stack = []  # 尚未闭合的开始括号位置
+    best = None
+    in_string = False
+    skip_to = start  # 转义字符之后的位置，之前的字符不再处理
+    # 由正则在C层跳过普通字符，Python循环只处理引号、反斜杠和括号
+    for match in _BRACKET_TOKEN_RE.finditer(text, start):
+        i = match.start()
+        if i < skip_to:
+            continue
+        ch = text[i]
+        if in_string:
+            if ch == '\\':
+                skip_to = i + 2
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch == open_ch:
+            stack.append(i)
+        elif ch == close_ch and stack:
+            begin = stack.pop()
+            if best is None or begin < best[0]:
+                best = (begin, i)
+            # 栈已清空说明之前的开始括号均已闭合，结果不会再变化
+            if not stack:
+                break
+    
+    if best is None:
+        return None
+    return text[best[0]:best[1] + 1]
+
+def _strip_code_blocks(text: str) -> str:
+    """
+    移除文本中成对的```代码块，未闭合的代码块标记保持原样
+    
+    Args:
+        text: 原始文本
+        
+    Returns:
+        移除代码块后的文本
+    """
+    start = text.find('```')
+    if start == -1:
+        return text
+    
+    parts = []
+    pos = 0
+    while start != -1:
+        end = text.find('```', start + 3)
+        if end == -1:
+            break
+        parts.append(text[pos:start])
+        pos = end + 3
+        start = text.find('```', pos)
+    parts.append(text[pos:])
+    return ''.join(parts)
+
+def _repair_match(match: re.Match) -> str:
+    """根据匹配到的分支返回_REPAIR_RE的替换文本"""
+    if match.group('key') is not None:
+        return f'{match.group("key_prefix")}"{match.group("key")}"'
+    if match.group('value') is not None:
+        return f': "{match.group("value")}"'
+    # 尾部逗号直接移除
+    return ''
+
+def _json_loads(data: Union[bytes, str]) -> Any:
+    """
+    解析JSON文本，安装了orjson时优先使用
+    
+    与api_connector、save_manager中的同名函数行为一致：orjson拒绝的写法（如NaN）交给标准库再试一次。
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(data)
+
+@lru_cache(maxsize=32)
+def _compile_pattern(pattern: str) -> Pattern:
+    """编译并缓存自定义正则表达式，重复创建解析器时复用编译结果"""
+    return re.compile(pattern)
+
 class BaseOutputParser(ABC, Generic[T]):
     """
     输出解析器基类
@@ -18,6 +156,8 @@ class BaseOutputParser(ABC, Generic[T]):
     所有自定义解析器都应该继承这个基类。
     """
     
+    __slots__ = ()
+    
     @abstractmethod
     def parse(self, output: str) -> T:
         """
@@ -38,8 +178,8 @@ class BaseOutputParser(ABC, Generic[T]):
         """
         异步解析输出内容
         
-        默认实现是在事件循环中运行同步parse方法
-        自定义解析器可以覆盖此方法以提供真正的异步实现
+        默认实现对较短的输出直接调用同步parse方法，较长的输出放到线程中解析，
+        避免阻塞事件循环。自定义解析器可以覆盖此方法以提供真正的异步实现
         
         Args:
             output: AI模型的原始输出
@@ -47,6 +187,8 @@ class BaseOutputParser(ABC, Generic[T]):
         Returns:
             解析后的结构化内容
         """
+        if len(output) < _INLINE_PARSE_LIMIT:
+            return self.parse(output)
         return await asyncio.to_thread(self.parse, output)
     
     @classmethod
@@ -67,12 +209,14 @@ class JSONOutputParser(BaseOutputParser[Dict[str, Any]]):
     可以从多种不规范的JSON格式中提取有效内容。
     """
     
-    def parse(self, output: str) -> Dict[str, Any]:
+    __slots__ = ()
+    
+    def parse(self, output: Union[str, bytes]) -> Dict[str, Any]:
         """
         解析JSON格式的输出
         
         Args:
-            output: AI模型的原始输出
+            output: AI模型的原始输出，也可以是未解码的HTTP响应体字节串
             
         Returns:
             解析后的JSON对象
@@ -80,28 +224,49 @@ class JSONOutputParser(BaseOutputParser[Dict[str, Any]]):
         Raises:
             ValueError: 当JSON解析完全失败且无法恢复时抛出
         """
+        # 字节串先直接交给orjson解析，避免不必要的解码
+        if isinstance(output, (bytes, bytearray)):
+            if orjson is not None:
+                try:
+                    obj = orjson.loads(output)
+                    if isinstance(obj, dict):
+                        return obj
+                except orjson.JSONDecodeError:
+                    pass
+            output = output.decode("utf-8", errors="replace")
+        
+        # 快速路径：大多数输出本身就是规范的JSON对象，从第一个起始字符直接解码
+        json_start = _JSON_START_RE.search(output)
+        if json_start:
+            try:
+                obj, _ = _DECODER.raw_decode(output, json_start.start())
+                if isinstance(obj, dict):
+                    return obj
+            except json.JSONDecodeError:
+                pass
+        
         try:
             # 清理输出文本
             cleaned_output = self._clean_output(output)
             # 解析JSON
-            return json.loads(cleaned_output)
+            return _json_loads(cleaned_output)
         except json.JSONDecodeError as e:
             # 尝试提取JSON部分
             json_text = self._extract_json(output)
             if json_text:
                 try:
-                    return json.loads(json_text)
+                    return _json_loads(json_text)
                 except json.JSONDecodeError:
                     # 尝试修复常见的JSON错误
                     fixed_json = self._attempt_json_repair(json_text)
                     if fixed_json:
                         try:
-                            return json.loads(fixed_json)
+                            return _json_loads(fixed_json)
                         except json.JSONDecodeError:
                             pass
             
             # 如果所有JSON解析方法都失败，尝试使用格式解析器
-            format_result = FormatPatternParser().parse(output)
+            format_result = OutputParser._instance(FormatPatternParser).parse(output)
             if format_result:
                 return format_result
                 
@@ -123,26 +288,23 @@ class JSONOutputParser(BaseOutputParser[Dict[str, Any]]):
         output = output.strip()
         
         # 移除可能的代码块标记 (多种格式)
-        output = re.sub(r'```(?:json|javascript|js)?\s*', '', output)
-        output = re.sub(r'```\s*$', '', output)
+        output = _CODEFENCE_OPEN_RE.sub('', output)
+        output = _CODEFENCE_CLOSE_RE.sub('', output)
         
         # 移除开头的可能解释文本，寻找第一个有效的JSON开始字符 ({[)
-        json_start = re.search(r'[{[]', output)
+        json_start = _JSON_START_RE.search(output)
         if json_start:
             output = output[json_start.start():]
         
         # 移除结尾的可能解释文本，确保JSON正确闭合
-        json_end = None
-        # 找到最后一个有效的JSON结束字符 (}])
-        for i in range(len(output) - 1, -1, -1):
-            if output[i] in '}]':
-                matching_char = '{' if output[i] == '}' else '['
-                # 简单检查括号是否匹配
-                if output.count(matching_char) >= output.count(output[i]):
-                    json_end = i
-                    break
-        
-        if json_end is not None and json_end < len(output) - 1:
+        # 括号计数与位置无关，只需各统计一次，再取最后一个匹配的结束字符 (}])
+        json_end = -1
+        if output.count('{') >= output.count('}'):
+            json_end = output.rfind('}')
+        if output.count('[') >= output.count(']'):
+            json_end = max(json_end, output.rfind(']'))
+        
+        if 0 <= json_end < len(output) - 1:
             output = output[:json_end + 1]
             
         return output
@@ -157,18 +319,11 @@ class JSONOutputParser(BaseOutputParser[Dict[str, Any]]):
         Returns:
             提取的可能包含JSON的文本，如果未找到则返回None
         """
-        # 改进的JSON提取模式，支持多层嵌套
-        json_patterns = [
-            # 标准对象模式
-            r'({[^{}]*(?:{[^{}]*(?:{[^{}]*}[^{}]*)*}[^{}]*)*})',
-            # 数组模式
-            r'(\[[^\[\]]*(?:\[[^\[\]]*(?:\[[^\[\]]*\][^\[\]]*)*\][^\[\]]*)*\])'
-        ]
-        
-        for pattern in json_patterns:
-            match = re.search(pattern, output, re.DOTALL)
-            if match:
-                return match.group(1)
+        # 依次尝试提取对象和数组，支持任意层嵌套
+        for open_ch, close_ch in (('{', '}'), ('[', ']')):
+            json_text = _extract_balanced(output, open_ch, close_ch)
+            if json_text:
+                return json_text
         
         return None
     
@@ -182,14 +337,12 @@ class JSONOutputParser(BaseOutputParser[Dict[str, Any]]):
         Returns:
             修复后的JSON文本，如果无法修复则返回None
         """
-        # 1. 尝试修复缺失的引号
-        json_text = re.sub(r'([{,]\s*)([a-zA-Z0-9_]+)(\s*:)', r'\1"\2"\3', json_text)
+        # 一次扫描同时修复键的缺失引号、尾部逗号和值的缺失引号
+        json_text, count = _REPAIR_RE.subn(_repair_match, json_text)
         
-        # 2. 尝试修复尾部逗号
-        json_text = re.sub(r',(\s*[}\]])', r'\1', json_text)
-        
-        # 3. 尝试修复缺失的引号在值周围
-        json_text = re.sub(r':\s*([a-zA-Z0-9_]+)(\s*[,}])', r': "\1"\2', json_text)
+        # 没有可修复的内容，再次解析也不会成功
+        if not count:
+            return None
         
         return json_text
 
@@ -201,6 +354,8 @@ class FormatPatternParser(BaseOutputParser[Dict[str, Any]]):
     可以识别多种常见的键值对格式。
     """
     
+    __slots__ = ('pattern', '_regex')
+    
     def __init__(self, pattern: Optional[str] = None):
         """
         初始化格式模式解析器
@@ -209,7 +364,8 @@ class FormatPatternParser(BaseOutputParser[Dict[str, Any]]):
             pattern: 可选，自定义正则表达式模式
         """
         # 默认模式匹配 key=value, key: value, "key"="value" 等常见格式
-        self.pattern = pattern if pattern else r'["\']?([^"\'=:]+)["\']?\s*[=:]\s*["\']?([^"\',}\]]*)["\']?[,}]?'
+        self.pattern = pattern if pattern else _KV_DEFAULT_PATTERN
+        self._regex = _compile_pattern(self.pattern)
     
     def parse(self, output: str) -> Dict[str, Any]:
         """
@@ -223,11 +379,11 @@ class FormatPatternParser(BaseOutputParser[Dict[str, Any]]):
         """
         result = {}
         # 先清理输出，移除可能的代码块等干扰
-        cleaned_output = re.sub(r'```.*?```', '', output, flags=re.DOTALL)
+        cleaned_output = _strip_code_blocks(output)
         cleaned_output = cleaned_output.strip()
         
         # 尝试匹配键值对
-        matches = re.finditer(self.pattern, cleaned_output)
+        matches = self._regex.finditer(cleaned_output)
         
         for match in matches:
             if len(match.groups()) >= 2:
@@ -250,19 +406,10 @@ class FormatPatternParser(BaseOutputParser[Dict[str, Any]]):
         """
         for key, value in data.items():
             if isinstance(value, str):
-                # 尝试转换为数字
-                if value.isdigit():
-                    data[key] = int(value)
-                elif re.match(r'^-?\d+(\.\d+)?$', value):
-                    data[key] = float(value)
-                # 尝试转换为布尔值
-                elif value.lower() in ('true', 'yes'):
-                    data[key] = True
-                elif value.lower() in ('false', 'no'):
-                    data[key] = False
-                # 尝试转换为None
-                elif value.lower() in ('none', 'null'):
-                    data[key] = None
+                # 一次匹配识别数字、布尔值和None
+                match = _VALUE_TYPE_RE.fullmatch(value)
+                if match:
+                    data[key] = _VALUE_CONVERTERS[match.lastgroup](value)
 
 class OutputParser:
     """
@@ -272,10 +419,11 @@ class OutputParser:
     支持注册自定义解析器和智能解析器选择。
     """
     
-    _parsers: Dict[str, Type[BaseOutputParser]] = {
+    # 只读映射，注册新解析器时整体替换
+    _parsers: Mapping[str, Type[BaseOutputParser]] = MappingProxyType({
         "json": JSONOutputParser,
         "format": FormatPatternParser
-    }
+    })
     
     @classmethod
     def register_parser(cls, name: str, parser_class: Type[BaseOutputParser]) -> None:
@@ -286,7 +434,25 @@ class OutputParser:
             name: 解析器名称
             parser_class: 解析器类
         """
-        cls._parsers[name] = parser_class
+        cls._parsers = MappingProxyType({**cls._parsers, name: parser_class})
+        # 同名解析器可能被替换，清空实例缓存
+        cls._instance.cache_clear()
+    
+    @staticmethod
+    @lru_cache(maxsize=16)
+    def _instance(parser_class: Type[BaseOutputParser]) -> BaseOutputParser:
+        """
+        获取解析器类的共享实例
+        
+        解析器不保存解析状态，每种解析器只创建一个实例即可
+        
+        Args:
+            parser_class: 解析器类
+            
+        Returns:
+            解析器实例
+        """
+        return parser_class()
     
     @classmethod
     def get_parser(cls, parser_type: str) -> BaseOutputParser:
@@ -302,10 +468,11 @@ class OutputParser:
         Raises:
             ValueError: 如果指定的解析器类型不存在
         """
-        if parser_type not in cls._parsers:
+        parser_class = cls._parsers.get(parser_type)
+        if parser_class is None:
             raise ValueError(f"未知的解析器类型: {parser_type}")
         
-        return cls._parsers[parser_type]()
+        return cls._instance(parser_class)
     
     @classmethod
     def get_parser_for_output(cls, output: str) -> BaseOutputParser:
@@ -320,11 +487,11 @@ class OutputParser:
         Returns:
             最合适的解析器实例
         """
-        # 检查输出是否看起来像JSON
-        if re.search(r'^\s*[{\[]', output) or '{"' in output or '":' in output:
+        # 检查输出是否看起来像JSON，先用字符比较，避免正则匹配
+        if output.lstrip()[:1] in ('{', '[') or '{"' in output or '":' in output:
             return cls.get_parser("json")
         # 检查是否看起来像键值对格式
-        elif re.search(r'[a-zA-Z_]+\s*[=:]\s*["\']?[^"\']*["\']?', output):
+        elif _LOOKS_LIKE_KV_RE.search(output):
             return cls.get_parser("format")
         # 默认使用JSON解析器
         return cls.get_parser("json")
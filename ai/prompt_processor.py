@@ -3,13 +3,147 @@
 """
 
 import re
-from typing import List, Dict, Any, Optional, Tuple
+import sys
+from collections import OrderedDict
+from functools import lru_cache
+from typing import List, Dict, Any, Optional, Sequence, Tuple
 import config
-from data.data_manager import load_save, get_nested_save_value
+from data.data_manager import load_save
+
+# 预编译的正则表达式
+_ARRAY_INDEX_RE = re.compile(r'([^\[]+)\[(\d+)\]')           # 数组索引，如items[0]
+_FIELD_TYPE_RE = re.compile(r'([^=,\s]+)=(["\'])([^"\']+)\2')  # 格式字段，如field="type"
+_SIMPLE_PLACEHOLDER_RE = re.compile(r'\{([^{]+?)\}')           # 不含嵌套的最内层占位符
+_BRACE_RE = re.compile(r'[{}]')                              # 花括号，用于扫描嵌套占位符
+_TEMPLATE_KEY_RE = re.compile(r'\{(\w+)\}')                   # 模板变量，如{json_format}
+
+# 自定义模板失败时使用的默认多字段模板
+_MULTI_FIELD_TEMPLATE = """请严格按照以下JSON格式输出，不要添加任何其他内容或解释。
+三引号中的内容是指令，您需要根据指令生成内容：
+
+{json_format}
+
+请确保输出是有效的JSON格式，包含所有指定的字段。
+提供给你的信息: {input_info}"""
+
+# 每个处理器缓存的已构建提示词数量
+_PROMPT_CACHE_SIZE = 256
+
+# 片段首尾字符到类型的映射：() 信息类，<> 输出内容类，[] 输出格式类
+_SEGMENT_KINDS = {
+    ("(", ")"): "info",
+    ("<", ">"): "content",
+    ("[", "]"): "format",
+}
+
+@lru_cache(maxsize=64)
+def _split_template(template: str) -> Tuple[str, ...]:
+    """
+    将模板预先拆分为文本和变量名交替的片段，同一模板只拆分一次
+    
+    Args:
+        template: 模板字符串
+        
+    Returns:
+        拆分结果，偶数位置为原样文本，奇数位置为变量名
+    """
+    return tuple(_TEMPLATE_KEY_RE.split(template))
+
+def _iter_placeholders(text: str):
+    """
+    单次扫描文本，找出最外层的成对花括号占位符
+    
+    用栈记录未闭合的左花括号，每个右花括号闭合最近的一个；后闭合且起点更靠前的
+    占位符包含之前闭合的占位符。多余的右花括号和未闭合的左花括号被忽略，最坏情况
+    也只扫描一遍文本，不会像嵌套重复的正则表达式那样回溯
+    
+    Args:
+        text: 包含占位符的文本
+        
+    Returns:
+        按出现顺序排列的(起始位置, 结束位置, 占位符内容)列表
+    """
+    opens = []
+    spans = []
+    for match in _BRACE_RE.finditer(text):
+        pos = match.start()
+        if text[pos] == '{':
+            opens.append(pos)
+        elif opens:
+            start = opens.pop()
+            # 丢弃被当前占位符包含的内层占位符
+            while spans and spans[-1][0] > start:
+                spans.pop()
+            spans.append((start, pos + 1))
+    return [(start, end, text[start + 1:end - 1]) for start, end in spans]
+
+@lru_cache(maxsize=256)
+def _parse_value_path(path: str) -> Tuple[Tuple[str, Optional[int]], ...]:
+    """
+    将点分隔的数据路径预先解析为(键, 数组索引)序列，同一路径只解析一次
+    
+    Args:
+        path: 点分隔的路径，如'a.items[0].c'
+        
+    Returns:
+        每一层的键和数组索引，不是数组索引的层索引为None
+    """
+    steps = []
+    for key in path.split('.'):
+        # 只有含方括号的键才需要匹配数组索引，如items[0]
+        array_match = _ARRAY_INDEX_RE.match(key) if '[' in key else None
+        if array_match:
+            steps.append((array_match.group(1), int(array_match.group(2))))
+        else:
+            steps.append((key, None))
+    return tuple(steps)
+
+@lru_cache(maxsize=128)
+def _render_json_template(fields: Tuple[Tuple[str, Tuple[str, str]], ...]) -> str:
+    """
+    生成JSON模板字符串，字段、类型和描述都相同的模板只生成一次
+    
+    Args:
+        fields: 按顺序排列的(字段名, (类型, 内容))元组
+        
+    Returns:
+        JSON格式的模板字符串，包含三引号描述
+    """
+    lines = ["{"]
+    
+    last = len(fields) - 1
+    for i, (field, (field_type, content)) in enumerate(fields):
+        # 添加字段和类型，逗号（除了最后一个字段）直接拼在该字段的最后一行
+        comma = ',' if i < last else ''
+        if content:
+            lines.append(f'  "{field}": "{field_type}"')
+            # 添加三引号描述
+            lines.append(f'  """{content}"""{comma}')
+        else:
+            lines.append(f'  "{field}": "{field_type}"{comma}')
+    
+    lines.append("}")
+    return "\n".join(lines)
+
+def _extract_field_types(format_str: str) -> List[Tuple[str, str]]:
+    """
+    提取格式片段中的字段名和类型: field="type", other="type" -> [(field, type), (other, type)]
+    
+    字段名会被驻留，后续作为字典键查找时可以直接比较对象
+    
+    Args:
+        format_str: 去掉方括号后的格式片段
+        
+    Returns:
+        按出现顺序排列的(字段名, 类型)列表
+    """
+    return [(sys.intern(match.group(1)), match.group(3)) for match in _FIELD_TYPE_RE.finditer(format_str)]
 
 class PromptProcessor:
     """提示词处理器，用于构建和处理提示词"""
     
+    __slots__ = ('_template', '_placeholders', '_prompt_cache')
+    
     def __init__(self, template: Optional[str] = None):
         """
         初始化提示词处理器
@@ -17,7 +151,7 @@ class PromptProcessor:
         Args:
             template: 可选，自定义提示词模板，默认使用配置中的模板
         """
-        self.template = template if template else config.DEFAULT_PROMPT_TEMPLATE
+        self.set_template(template if template else config.DEFAULT_PROMPT_TEMPLATE)
     
     def _get_nested_value(self, data: Dict[str, Any], path: str, default=None):
         """
@@ -31,29 +165,19 @@ class PromptProcessor:
         Returns:
             路径指定的值或默认值
         """
-        keys = path.split('.')
         result = data
         
-        for key in keys:
+        for key, index in _parse_value_path(path):
+            if not isinstance(result, dict) or key not in result:
+                return default
+            result = result[key]
+            
             # 处理数组索引，如items[0]
-            array_match = re.match(r'([^\[]+)\[(\d+)\]', key)
-            if array_match:
-                array_key = array_match.group(1)
-                index = int(array_match.group(2))
-                
-                if isinstance(result, dict) and array_key in result:
-                    array_value = result[array_key]
-                    if isinstance(array_value, list) and 0 <= index < len(array_value):
-                        result = array_value[index]
-                    else:
-                        return default
+            if index is not None:
+                if isinstance(result, list) and 0 <= index < len(result):
+                    result = result[index]
                 else:
                     return default
-            # 处理普通键
-            elif isinstance(result, dict) and key in result:
-                result = result[key]
-            else:
-                return default
         
         return result
     
@@ -74,48 +198,28 @@ class PromptProcessor:
             "pairs": []      # 按顺序配对的<内容>和[格式]
         }
         
-        # 先按类型分类所有片段
+        # 单次遍历：按类型分类片段，同时将紧邻的<内容>和[格式]配对
+        prev_content = None  # 上一个片段为<内容>时记录其内容
         for segment in segments:
             segment = segment.strip()
-            if segment.startswith("(") and segment.endswith(")"):
-                # 信息类提示词
-                result["info"].append(segment[1:-1])
-            elif segment.startswith("<") and segment.endswith(">"):
-                # 输出内容类提示词
-                result["content"].append(segment[1:-1])
-            elif segment.startswith("[") and segment.endswith("]"):
-                # 输出格式类提示词
-                result["format"].append(segment[1:-1])
-        
-        # 匹配内容和格式的配对
-        content_formats = []
-        i = 0
-        while i < len(segments) - 1:
-            current = segments[i].strip()
-            next_seg = segments[i + 1].strip()
+            kind = _SEGMENT_KINDS.get((segment[:1], segment[-1:]))
+            if not kind:
+                prev_content = None
+                continue
+            
+            body = segment[1:-1]
+            result[kind].append(body)
             
-            if current.startswith("<") and current.endswith(">") and next_seg.startswith("[") and next_seg.endswith("]"):
+            if kind == "format" and prev_content is not None:
                 # 找到一对配对的内容和格式
-                content = current[1:-1]
-                format_str = next_seg[1:-1]
-                
-                # 提取字段名和类型: [field="type"] -> field, type
-                field_types = {}
-                for match in re.finditer(r'([^=,\s]+)=["\'"]([^"\']+)["\']', format_str):
-                    field_name = match.group(1)
-                    field_type = match.group(2)
-                    field_types[field_name] = field_type
-                
-                content_formats.append({
-                    "content": content,
-                    "format": format_str,
-                    "field_types": field_types
+                result["pairs"].append({
+                    "content": prev_content,
+                    "format": body,
+                    "field_types": _extract_field_types(body)
                 })
-                i += 2  # 跳过已配对的两个片段
-            else:
-                i += 1  # 没找到配对，继续下一个
+            
+            prev_content = body if kind == "content" else None
         
-        result["pairs"] = content_formats
         return result
     
     def _build_json_template(self, fields_content: Dict[str, Tuple[str, str]]) -> str:
@@ -128,25 +232,8 @@ class PromptProcessor:
         Returns:
             JSON格式的模板字符串，包含三引号描述
         """
-        lines = ["{"]
-        
-        fields = list(fields_content.keys())
-        for i, field in enumerate(fields):
-            field_type, content = fields_content[field]
-            
-            # 添加字段和类型
-            lines.append(f'  "{field}": "{field_type}"')
-            
-            # 添加三引号描述
-            if content:
-                lines.append(f'  """{content}"""')
-            
-            # 添加逗号（除了最后一个字段）
-            if i < len(fields) - 1:
-                lines[-1] += ','
-        
-        lines.append("}")
-        return "\n".join(lines)
+        # 字段顺序决定输出顺序，按顺序转为元组作为缓存键
+        return _render_json_template(tuple(fields_content.items()))
     
     def _apply_template(self, template: str, replacements: Dict[str, str]) -> str:
         """
@@ -159,11 +246,12 @@ class PromptProcessor:
         Returns:
             替换后的字符串
         """
-        result = template
-        for key, value in replacements.items():
-            if f"{{{key}}}" in result:
-                result = result.replace(f"{{{key}}}", value)
-        return result
+        # 使用预先拆分的模板片段拼接，未知的变量保持原样
+        parts = _split_template(template)
+        result = list(parts)
+        for i in range(1, len(parts), 2):
+            result[i] = replacements.get(parts[i], f"{{{parts[i]}}}")
+        return "".join(result)
     
     def _replace_placeholders(self, text: str, save_data: Dict[str, Any]) -> str:
         """
@@ -184,106 +272,140 @@ class PromptProcessor:
         # 如果没有占位符，直接返回
         if '{' not in text:
             return text
+        return self._replace_segment_placeholders((text,), save_data)[0]
+    
+    def _replace_segment_placeholders(self, segments: Sequence[str],
+                                      save_data: Dict[str, Any]) -> Tuple[str, ...]:
+        """
+        替换多个片段中的占位符，所有片段共享已加载的文本数据文件和已解析的占位符
         
-        # 最多循环20次，避免可能的无限递归
-        for i in range(20):
-            # 记录之前的文本，用于检测是否有变化
-            previous_text = text
-            
-            # 查找所有占位符，优先处理没有嵌套的占位符
-            # 这个正则表达式会匹配不包含{的占位符，即最内层的占位符
-            simple_pattern = r'\{([^{]+?)\}'
-            matches = list(re.finditer(simple_pattern, text))
+        Args:
+            segments: 包含占位符的片段
+            save_data: 存档数据
             
-            # 如果没有找到简单占位符，但文本中仍有占位符，可能是嵌套结构不完整
-            if not matches and '{' in text:
-                # 尝试匹配所有占位符，可能包含嵌套结构
-                all_pattern = r'\{([^{}]*(?:\{[^{}]*\}[^{}]*)*)\}'
-                matches = list(re.finditer(all_pattern, text))
+        Returns:
+            替换后的片段
+        """
+        # 本次替换中已加载的文本数据文件，同一文件被多次引用时只加载一次
+        text_files = {}
+        # 本次替换中已解析的占位符，同一占位符多次出现时只解析一次
+        resolved = {}
+        
+        def resolve_content(content):
+            if content in resolved:
+                return resolved[content]
+            replaced_value = resolved[content] = self._resolve_placeholder(content, save_data, text_files)
+            return replaced_value
+        
+        def resolve(match):
+            # 无法解析的占位符保持原样
+            replaced_value = resolve_content(match.group(1))
+            return match.group(0) if replaced_value is None else replaced_value
+        
+        results = []
+        for text in segments:
+            # 没有占位符的片段原样保留
+            if '{' not in text:
+                results.append(text)
+                continue
             
-            if not matches:
-                break  # 没有找到任何占位符，结束循环
-                
-            # 处理找到的每个占位符
-            for match in matches:
-                placeholder = match.group(0)  # 完整的占位符，如{character.name}
-                content = match.group(1)      # 占位符内容，如character.name
+            # 最多循环20次，避免可能的无限递归
+            for i in range(20):
+                # 优先处理没有嵌套的占位符，即最内层的占位符，一次扫描完成本轮所有替换
+                new_text, count = _SIMPLE_PLACEHOLDER_RE.subn(resolve, text)
                 
-                replaced_value = None  # 存储替换的值
+                # 如果没有找到简单占位符，可能是嵌套结构不完整，按最外层的成对花括号替换
+                if not count:
+                    pieces = []
+                    pos = 0
+                    for start, end, content in _iter_placeholders(text):
+                        replaced_value = resolve_content(content)
+                        pieces.append(text[pos:start])
+                        pieces.append(text[start:end] if replaced_value is None else replaced_value)
+                        pos = end
+                        count += 1
+                    pieces.append(text[pos:])
+                    new_text = "".join(pieces)
                 
-                # 处理text格式的占位符 {text;file;path}
-                if content.startswith('text;'):
-                    parts = content.split(';', 2)
-                    if len(parts) == 3:
-                        file_name = parts[1]
-                        path = parts[2]
-                        
-                        try:
-                            # 加载指定的文本数据文件
-                            file_data = load_save('text', file_name)
-                            if file_data:
-                                # 从文件中提取指定路径的数据
-                                value = self._get_nested_value(file_data, path)
-                                if value is not None:
-                                    replaced_value = str(value)
-                                else:
-                                    replaced_value = f"未找到数据: {path}"
-                            else:
-                                replaced_value = f"文件不存在: {file_name}"
-                        except Exception as e:
-                            replaced_value = f"错误: {str(e)}"
+                # 没有找到任何占位符，或文本没有变化，结束循环
+                if not count or new_text == text:
+                    break
                 
-                # 处理嵌套路径格式 {key.subkey}
-                elif '.' in content:
-                    parts = content.split('.', 1)
-                    key = parts[0]
-                    subpath = parts[1]
-                    
-                    # 从save_data中提取数据
-                    if key in save_data:
-                        # 处理嵌套字典
-                        if isinstance(save_data[key], dict):
-                            value = self._get_nested_value(save_data[key], subpath)
-                            if value is not None:
-                                replaced_value = str(value)
-                        # 处理嵌套列表
-                        elif isinstance(save_data[key], list):
-                            # 尝试处理数组索引，如skills[0]
-                            array_match = re.match(r'([^\[]+)\[(\d+)\]', subpath)
-                            if array_match:
-                                array_key = array_match.group(1)
-                                if array_key == '':  # 直接使用数组索引
-                                    index = int(array_match.group(2))
-                                    if 0 <= index < len(save_data[key]):
-                                        replaced_value = str(save_data[key][index])
-                            elif subpath:  # 有子路径但不是索引格式
-                                replaced_value = str(save_data[key])
-                            else:  # 没有子路径，直接返回整个数组
-                                replaced_value = str(save_data[key])
-                
-                # 处理简单格式 {key}
-                else:
-                    key = content
-                    if key in save_data:
-                        # 根据类型进行处理
-                        value = save_data[key]
-                        if isinstance(value, (dict, list)):
-                            replaced_value = str(value)
-                        else:
-                            replaced_value = str(value)
-                
-                # 如果成功获取了替换值，则替换占位符
-                if replaced_value is not None:
-                    text = text.replace(placeholder, replaced_value)
+                text = new_text
+                if '{' not in text:
+                    break
+            results.append(text)
+        
+        return tuple(results)
+    
+    def _resolve_placeholder(self, content: str, save_data: Dict[str, Any],
+                             text_files: Optional[Dict[str, Any]] = None) -> Optional[str]:
+        """
+        解析单个占位符的内容
+        
+        Args:
+            content: 占位符内容，如character.name
+            save_data: 存档数据
+            text_files: 可选，文件名到已加载文本数据的映射，用于复用已加载的文件
             
-            # 如果文本没有变化，且没有嵌套占位符，结束循环
-            if text == previous_text:
-                break
+        Returns:
+            替换的值，无法解析时返回None
+        """
+        # 处理text格式的占位符 {text;file;path}
+        if content.startswith('text;'):
+            parts = content.split(';', 2)
+            if len(parts) == 3:
+                file_name = parts[1]
+                path = parts[2]
+                
+                try:
+                    # 加载指定的文本数据文件，不存在的文件也只查找一次
+                    if text_files is None:
+                        file_data = load_save('text', file_name)
+                    elif file_name in text_files:
+                        file_data = text_files[file_name]
+                    else:
+                        file_data = text_files[file_name] = load_save('text', file_name)
+                    if file_data:
+                        # 从文件中提取指定路径的数据
+                        value = self._get_nested_value(file_data, path)
+                        if value is not None:
+                            return str(value)
+                        return f"未找到数据: {path}"
+                    return f"文件不存在: {file_name}"
+                except Exception as e:
+                    return f"错误: {str(e)}"
+            return None
+        
+        # 处理嵌套路径格式 {key.subkey}
+        if '.' in content:
+            key, subpath = content.split('.', 1)
             
-            # 打印当前处理结果，便于调试（可选）
-            # print(f"迭代 {i+1}: {text}")
+            # 从save_data中提取数据
+            data = save_data.get(key)
+            # 处理嵌套字典，与文本数据路径共用同一套路径解析
+            if isinstance(data, dict):
+                value = self._get_nested_value(data, subpath)
+                if value is not None:
+                    return str(value)
+            # 处理嵌套列表
+            elif isinstance(data, list):
+                # 尝试处理数组索引，如skills[0]
+                array_match = _ARRAY_INDEX_RE.match(subpath)
+                if array_match:
+                    array_key = array_match.group(1)
+                    if array_key == '':  # 直接使用数组索引
+                        index = int(array_match.group(2))
+                        if 0 <= index < len(data):
+                            return str(data[index])
+                else:  # 有子路径但不是索引格式，或没有子路径，直接返回整个数组
+                    return str(data)
+            return None
         
-        return text
+        # 处理简单格式 {key}
+        if content in save_data:
+            return str(save_data[content])
+        return None
     
     def build_prompt(self, segments: List[str], save_data: Dict[str, Any] = None) -> str:
         """
@@ -299,28 +421,44 @@ class PromptProcessor:
         if save_data is None:
             save_data = {}
         
-        # 替换片段中的占位符
-        processed_segments = []
-        for segment in segments:
-            processed_segments.append(self._replace_placeholders(segment, save_data))
+        # 替换片段中的占位符，之后的组装过程只取决于处理后的片段和模板
+        processed_segments = self._replace_segment_placeholders(segments, save_data)
+        
+        # 相同片段直接使用缓存的提示词
+        prompt = self._prompt_cache.get(processed_segments)
+        if prompt is not None:
+            self._prompt_cache.move_to_end(processed_segments)
+            return prompt
+        
+        prompt = self._assemble_prompt(processed_segments)
+        self._prompt_cache[processed_segments] = prompt
+        if len(self._prompt_cache) > _PROMPT_CACHE_SIZE:
+            self._prompt_cache.popitem(last=False)
+        return prompt
+    
+    def _assemble_prompt(self, processed_segments: Tuple[str, ...]) -> str:
+        """
+        根据已替换占位符的片段组装提示词
         
+        Args:
+            processed_segments: 已替换占位符的提示词片段
+            
+        Returns:
+            构建好的完整提示词
+        """
         # 解析处理后的片段
         parsed = self.parse_segments(processed_segments)
         
-        # 组合信息类提示词
-        input_info = " ".join([f"({info})" for info in parsed["info"]])
+        # 组合信息类提示词，括号包裹的结果在多个替换项中复用
+        info_parens = [f"({info})" for info in parsed["info"]]
+        input_info = " ".join(info_parens)
         
-        # 提取字段和内容
-        fields_content = {}
-        
-        # 从配对中提取
-        if parsed["pairs"]:
-            for pair in parsed["pairs"]:
-                content = pair["content"]
-                field_types = pair.get("field_types", {})
-                
-                for field, field_type in field_types.items():
-                    fields_content[field] = (field_type, content)
+        # 从配对中提取字段和内容，后出现的同名字段覆盖之前的
+        fields_content = {
+            field: (field_type, pair["content"])
+            for pair in parsed["pairs"]
+            for field, field_type in pair["field_types"]
+        }
         
         # 构建JSON模板
         json_template = self._build_json_template(fields_content)
@@ -329,30 +467,33 @@ class PromptProcessor:
         if self.template:
             try:
                 replacements = {
-                    "background": "\n".join([f"({info})" for info in parsed["info"]]),
-                    "content": "\n".join([f"<{content}>" for content in parsed["content"]]),
                     "format": json_template,
                     "input_info": input_info,
                     "json_format": json_template
                 }
+                if "background" in self._placeholders:
+                    replacements["background"] = "\n".join(info_parens)
+                if "content" in self._placeholders:
+                    replacements["content"] = "\n".join(f"<{content}>" for content in parsed["content"])
                 return self._apply_template(self.template, replacements)
             except Exception as e:
                 print(f"使用自定义模板失败: {str(e)}，回退到默认模板")
         
         # 使用默认的多字段模板
-        multi_field_template = """请严格按照以下JSON格式输出，不要添加任何其他内容或解释。
-三引号中的内容是指令，您需要根据指令生成内容：
-
-{json_format}
-
-请确保输出是有效的JSON格式，包含所有指定的字段。
-提供给你的信息: {input_info}"""
-        
-        return self._apply_template(multi_field_template, {
+        return self._apply_template(_MULTI_FIELD_TEMPLATE, {
             "json_format": json_template,
             "input_info": input_info
         })
     
+    @property
+    def template(self) -> str:
+        """当前的提示词模板，直接赋值与调用set_template效果相同"""
+        return self._template
+    
+    @template.setter
+    def template(self, template: str) -> None:
+        self.set_template(template)
+    
     def set_template(self, template: str) -> None:
         """
         设置新的提示词模板
@@ -360,4 +501,8 @@ class PromptProcessor:
         Args:
             template: 新的提示词模板
         """
-        self.template = template 
\ No newline at end of file
+        self._template = template
+        # 记录模板中出现的变量，构建提示词时只生成需要的替换内容
+        self._placeholders = frozenset(_split_template(template or "")[1::2])
+        # 模板变化后之前构建的提示词全部失效
+        self._prompt_cache = OrderedDict() 
\ No newline at end of file
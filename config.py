@@ -32,6 +32,21 @@ DEFAULT_PROMPT_TEMPLATE = """请严格按照以下JSON格式输出，不要添
 # 超时设置
 API_TIMEOUT = 30  # 秒
 
+# 响应大小上限，超出时中止读取
+MAX_RESPONSE_BYTES = 4 * 1024 * 1024  # 字节
+
+# 异步调用时同时进行的最大请求数
+MAX_CONCURRENCY = 8
+
 # 重试设置
 MAX_RETRIES = 3
-RETRY_DELAY = 2  # 秒
\ No newline at end of file
+RETRY_DELAY = 2  # 秒，指数退避的初始等待时间
+RETRY_MAX_DELAY = 60  # 秒，单次退避等待的上限
+
+# 响应缓存设置
+RESPONSE_CACHE_SIZE = 1024  # 最多缓存的响应条数
+CACHE_MAX_TEMPERATURE = 0.2  # 仅缓存温度不高于此值的调用（结果可复现）
+
+# 存档设置
+SAVE_FSYNC = False  # 写入存档后是否立即同步到磁盘，更安全但写入更慢
+SAVE_JSON_INDENT = 4  # 存档文件的JSON缩进，设为None时紧凑写入，文件更小、写入更快
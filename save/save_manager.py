@@ -7,6 +7,31 @@ import sys
 import json
 import time
 from collections import defaultdict
+from contextlib import contextmanager
+import config
+
+try:
+    import orjson
+except ImportError:  # 未安装orjson时回退到标准库json
+    orjson = None
+
+def _json_loads(data):
+    """
+    解析JSON字节内容，安装了orjson时优先使用
+    
+    参数:
+        data (bytes): JSON文件内容
+    
+    返回:
+        解析后的数据
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # orjson不接受NaN等标准库能解析的写法，交给标准库再试一次
+            pass
+    return json.loads(data)
 
 class SaveManager:
     def __init__(self, save_dir=None, save_name=None):
@@ -47,6 +72,10 @@ class SaveManager:
             "attribute_categories": {}
         }
         
+        # 批量更新状态：批量更新期间只标记有未写入的修改，结束时统一写入
+        self._batch_depth = 0
+        self._dirty = False
+        
         # 加载存档
         self._load_save()
     
@@ -59,8 +88,8 @@ class SaveManager:
         """
         try:
             if os.path.exists(self._save_file):
-                with open(self._save_file, 'r', encoding='utf-8') as f:
-                    self._save_data = json.load(f)
+                with open(self._save_file, 'rb') as f:
+                    self._save_data = _json_loads(f.read())
                     
                     # 兼容旧版数据结构
                     if "角色数据" in self._save_data:
@@ -93,7 +122,19 @@ class SaveManager:
     
     def _save_data_to_file(self):
         """
-        将数据保存到文件
+        将数据保存到文件，批量更新期间推迟到批量结束时写入
+        
+        返回:
+            bool: 是否保存成功
+        """
+        if self._batch_depth:
+            self._dirty = True
+            return True
+        return self._write_save_file()
+    
+    def _write_save_file(self):
+        """
+        将数据写入存档文件
         
         返回:
             bool: 是否保存成功
@@ -105,14 +146,58 @@ class SaveManager:
             # 确保目录存在
             os.makedirs(os.path.dirname(self._save_file), exist_ok=True)
             
-            # 写入文件
-            with open(self._save_file, 'w', encoding='utf-8') as f:
-                json.dump(self._save_data, f, ensure_ascii=False, indent=4)
+            # 先完整编码再一次性写入临时文件，写完后替换存档文件，
+            # 写入中途出错也不会损坏原有存档
+            indent = config.SAVE_JSON_INDENT
+            content = json.dumps(self._save_data, ensure_ascii=False, indent=indent,
+                                 separators=None if indent is not None else (',', ':')).encode('utf-8')
+            temp_file = self._save_file + ".tmp"
+            with open(temp_file, 'wb') as f:
+                f.write(content)
+                if config.SAVE_FSYNC:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(temp_file, self._save_file)
+            self._dirty = False
             return True
         except Exception as e:
             print(f"保存存档失败: {str(e)}")
             return False
     
+    def flush(self):
+        """
+        立即写入尚未保存的修改
+        
+        返回:
+            bool: 是否保存成功，没有未保存的修改时返回True
+        """
+        if not self._dirty:
+            return True
+        return self._write_save_file()
+    
+    @contextmanager
+    def batch(self):
+        """
+        批量更新存档，期间的修改只在内存中进行，结束时统一写入一次文件
+        
+        异常:
+            OSError: 批量结束时写入存档失败
+        
+        示例:
+            with save_manager.batch():
+                save_manager.update_metadata("character_name", "张三")
+                save_manager.update_metadata("description", "新的冒险")
+        """
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            flushed = self._batch_depth or self.flush()
+        # with块内已抛出异常时不会执行到这里，避免覆盖原来的异常
+        if not flushed:
+            raise OSError(f"保存存档 '{self._current_save_name}' 失败")
+    
     def get_current_save_data(self):
         """
         获取当前存档数据
@@ -231,6 +316,10 @@ class SaveManager:
             if os.path.exists(save_file):
                 print(f"存档 '{save_name}' 已存在")
                 return False
+            
+            # 切换前写入当前存档未保存的修改，写入失败时不切换，避免丢失修改
+            if not self.flush():
+                return False
                 
             # 更新当前存档信息
             self._current_save_name = save_name
@@ -250,8 +339,8 @@ class SaveManager:
                 "attribute_categories": {}
             }
             
-            # 保存到文件
-            result = self._save_data_to_file()
+            # 新存档必须立即落盘，批量更新期间也不推迟
+            result = self._write_save_file()
             if result:
                 print(f"已创建存档 '{save_name}'")
                 # 更新配置文件
@@ -278,6 +367,10 @@ class SaveManager:
             if not os.path.exists(save_file):
                 print(f"存档 '{save_name}' 不存在")
                 return False
+            
+            # 切换前写入当前存档未保存的修改，写入失败时不切换，避免丢失修改
+            if not self.flush():
+                return False
                 
             # 更新当前存档信息
             self._current_save_name = save_name
@@ -347,6 +440,10 @@ class SaveManager:
             if os.path.exists(new_save_path):
                 print(f"存档名称 '{new_name}' 已被使用")
                 return False
+            
+            # 重命名前写入未保存的修改，避免之后写到旧路径
+            if not self.flush():
+                return False
                 
             # 重命名文件
             os.rename(old_save_path, new_save_path)
@@ -358,7 +455,7 @@ class SaveManager:
                 
                 # 更新存档内的名称
                 self._save_data["metadata"]["save_name"] = new_name
-                self._save_data_to_file()
+                self._write_save_file()
                 
                 # 更新配置文件
                 self._save_save_config()
@@ -387,8 +484,8 @@ class SaveManager:
                 print(f"存档 '{save_name}' 不存在")
                 return None
                 
-            with open(save_file, 'r', encoding='utf-8') as f:
-                save_data = json.load(f)
+            with open(save_file, 'rb') as f:
+                save_data = _json_loads(f.read())
                 
                 # 兼容旧版数据结构
                 if "角色数据" in save_data:
@@ -477,8 +574,20 @@ class SaveManager:
             print(f"加载上次存档失败: {str(e)}")
         return False
 
-# 初始化保存管理器
-save_manager = SaveManager()
+# 全局保存管理器实例，首次使用时才创建，避免导入模块时就读取存档文件
+save_manager = None
+
+def _get_save_manager():
+    """
+    获取全局保存管理器，尚未配置时使用默认设置创建
+    
+    返回:
+        SaveManager: 全局保存管理器
+    """
+    global save_manager
+    if save_manager is None:
+        save_manager = SaveManager()
+    return save_manager
 
 # 下面是公共接口函数，提供给外部模块使用
 
@@ -504,7 +613,7 @@ def list_saves():
     返回:
         list: 存档名称列表
     """
-    return save_manager.list_saves()
+    return _get_save_manager().list_saves()
 
 def create_save(save_name, character_name="", description=""):
     """
@@ -518,7 +627,7 @@ def create_save(save_name, character_name="", description=""):
     返回:
         bool: 是否创建成功
     """
-    return save_manager.create_save(save_name, character_name, description)
+    return _get_save_manager().create_save(save_name, character_name, description)
 
 def load_save(save_name):
     """
@@ -530,7 +639,7 @@ def load_save(save_name):
     返回:
         bool: 是否加载成功
     """
-    return save_manager.load_save(save_name)
+    return _get_save_manager().load_save(save_name)
 
 def delete_save(save_name):
     """
@@ -542,7 +651,7 @@ def delete_save(save_name):
     返回:
         bool: 是否删除成功
     """
-    return save_manager.delete_save(save_name)
+    return _get_save_manager().delete_save(save_name)
 
 def rename_save(old_name, new_name):
     """
@@ -555,7 +664,7 @@ def rename_save(old_name, new_name):
     返回:
         bool: 是否重命名成功
     """
-    return save_manager.rename_save(old_name, new_name)
+    return _get_save_manager().rename_save(old_name, new_name)
 
 def get_current_save_name():
     """
@@ -564,7 +673,7 @@ def get_current_save_name():
     返回:
         str: 当前存档名称
     """
-    return save_manager.get_current_save_name()
+    return _get_save_manager().get_current_save_name()
 
 def get_save_metadata():
     """
@@ -573,7 +682,7 @@ def get_save_metadata():
     返回:
         dict: 存档元数据
     """
-    return save_manager.get_save_metadata()
+    return _get_save_manager().get_save_metadata()
 
 def update_save_metadata(key, value):
     """
@@ -586,7 +695,7 @@ def update_save_metadata(key, value):
     返回:
         bool: 是否更新成功
     """
-    return save_manager.update_metadata(key, value)
+    return _get_save_manager().update_metadata(key, value)
 
 def get_current_save_data():
     """
@@ -595,7 +704,7 @@ def get_current_save_data():
     返回:
         dict: 当前存档数据
     """
-    return save_manager.get_current_save_data()
+    return _get_save_manager().get_current_save_data()
 
 def update_save_data(save_data):
     """
@@ -607,7 +716,28 @@ def update_save_data(save_data):
     返回:
         bool: 是否更新成功
     """
-    return save_manager.update_save_data(save_data)
+    return _get_save_manager().update_save_data(save_data)
+
+def batch_update():
+    """
+    批量更新当前存档，期间的修改在结束时统一写入一次文件
+    
+    返回:
+        上下文管理器，用于with语句
+    
+    异常:
+        OSError: 批量结束时写入存档失败
+    """
+    return _get_save_manager().batch()
+
+def flush_save_data():
+    """
+    立即写入当前存档尚未保存的修改
+    
+    返回:
+        bool: 是否保存成功
+    """
+    return _get_save_manager().flush()
 
 def get_save_file_path():
     """
@@ -616,7 +746,7 @@ def get_save_file_path():
     返回:
         str: 存档文件的完整路径
     """
-    return save_manager.get_save_file_path()
+    return _get_save_manager().get_save_file_path()
 
 def read_save_data(save_name):
     """
@@ -628,7 +758,7 @@ def read_save_data(save_name):
     返回:
         dict: 存档数据，读取失败则返回None
     """
-    return save_manager.read_save_data(save_name)
+    return _get_save_manager().read_save_data(save_name)
 
 def load_previous_save():
     """
@@ -637,4 +767,4 @@ def load_previous_save():
     返回:
         bool: 是否加载成功
     """
-    return save_manager.load_previous_save() 
\ No newline at end of file
+    return _get_save_manager().load_previous_save() 
\ No newline at end of file
@@ -6,6 +6,7 @@
 """
 
 import os
+import re
 import json
 import time
 import uuid
@@ -26,6 +27,9 @@ from data.data_manager import (
     save_data
 )
 
+# 存储路径中的变量占位符，如{type}
+_PATH_VAR_RE = re.compile(r'\{([^{}]+)\}')
+
 class StorylineManager:
     """故事线管理器，负责模板管理和故事生成
     
@@ -180,9 +184,7 @@ class StorylineManager:
             替换后的文本
         """
         # 使用PromptProcessor的实现
-        from ai.prompt_processor import PromptProcessor
-        processor = PromptProcessor()
-        return processor._replace_placeholders(text, save_data)
+        return self.prompt_processor._replace_placeholders(text, save_data)
     
     def _process_template_segments(self, segments: List[str], save_data: Dict[str, Any]) -> List[str]:
         """处理模板片段，替换其中的存档数据占位符
@@ -284,15 +286,13 @@ class StorylineManager:
         解析路径字符串为token列表，支持变量替换与数组索引。
         例如："{type}.arr[1].x" -> ['实际type值', 'arr', 1, 'x']
         """
-        import re
         tokens = []
         # 变量替换
         def replace_var(match):
             var_name = match.group(1)
             return str(current_save.get(var_name, var_name))
-        path_str = re.sub(r'\{([^{}]+)\}', replace_var, path_str)
+        path_str = _PATH_VAR_RE.sub(replace_var, path_str)
         # 分割并处理数组
-        pattern = r'([^.\[\]]+)|(\[\d+\])'
         for part in path_str.split('.'):
             # 处理数组索引
             while '[' in part and ']' in part:
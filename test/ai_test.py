@@ -21,7 +21,10 @@ import time
 import argparse
 import unittest
 import re
-from unittest.mock import patch, MagicMock
+import asyncio
+from types import MappingProxyType
+import importlib.util
+from unittest.mock import patch, MagicMock, AsyncMock
 from typing import Dict, Any, List, Optional
 
 # 添加项目根目录到Python路径以便导入模块
@@ -40,7 +43,7 @@ import config
 
 # 测试数据常量
 TEST_API_KEY = "test_api_key_for_mock_responses"
-MOCK_RESPONSES = {
+MOCK_RESPONSES = MappingProxyType({
     "standard_json": """{"name": "李白", "occupation": "诗人", "famous_work": "将进酒"}""",
     "with_markdown": """```json
     {
@@ -60,15 +63,53 @@ MOCK_RESPONSES = {
         occupation: "诗人",
         "famous_work": "将进酒"
     }""",
-    "key_value_pairs": """name="李白" occupation="诗人" famous_work="将进酒" """
-}
+    "key_value_pairs": """name="李白" occupation="诗人" famous_work="将进酒" """,
+    "csv": "name,occupation,famous_work\n李白,诗人,将进酒",
+    "xml": """
+        <name>李白</name>
+        <occupation>诗人</occupation>
+        <famous_work>将进酒</famous_work>
+        """
+})
+# 模拟的chat/completions响应体
+MOCK_API_BODY = json.dumps({
+    "choices": [
+        {
+            "message": {
+                "content": MOCK_RESPONSES["standard_json"]
+            }
+        }
+    ]
+}).encode("utf-8")
+
+# 默认模板的处理器无状态，所有测试共用一个实例
+_DEFAULT_PROCESSOR = PromptProcessor()
+
+def _sent_payload(call_args) -> Dict[str, Any]:
+    """从模拟的post调用参数中取出发送的请求负载"""
+    kwargs = call_args.kwargs
+    return kwargs["json"] if "json" in kwargs else json.loads(kwargs["data"])
+
+def _mock_http_response(status_code: int, body: bytes = b"", headers: Optional[Dict[str, str]] = None) -> MagicMock:
+    """构造支持分块读取（同步与异步）的模拟HTTP响应"""
+    mock_response = MagicMock()
+    mock_response.status_code = status_code
+    mock_response.headers = headers or {}
+    mock_response.iter_content.return_value = [body]
+    
+    async def aiter_bytes():
+        yield body
+    
+    mock_response.aiter_bytes = aiter_bytes
+    mock_response.aclose = AsyncMock()
+    return mock_response
 
 class PromptProcessorTests(unittest.TestCase):
     """测试提示词处理器功能"""
     
     def setUp(self):
         """测试前的设置"""
-        self.processor = PromptProcessor()
+        self.processor = _DEFAULT_PROCESSOR
         self.test_segments = [
             "(角色是诗人)",
             "(朝代是唐代)",
@@ -93,6 +134,47 @@ class PromptProcessorTests(unittest.TestCase):
         self.assertEqual(len(parsed["format"]), 1)
         self.assertEqual(parsed["format"][0], "poem=\"*\"")
     
+    def test_parse_segments_field_types(self):
+        """测试格式片段的字段类型提取，引号必须成对"""
+        parsed = self.processor.parse_segments([
+            "<描述人物>",
+            "[name=\"string\", age='int', bad='x\", mixed=\"y']"
+        ])
+        
+        self.assertEqual(parsed["pairs"][0]["field_types"], [("name", "string"), ("age", "int")])
+    
+    def test_text_placeholder_file_reuse(self):
+        """测试同一文本数据文件在一次替换中只加载一次"""
+        text_data = {"poets": ["李白", "杜甫"]}
+        
+        with patch("ai.prompt_processor.load_save", return_value=text_data) as mock_load:
+            text = self.processor._replace_placeholders(
+                "{text;poets;poets[0]}与{text;poets;poets[1]}", {})
+        
+        self.assertEqual(text, "李白与杜甫")
+        mock_load.assert_called_once_with("text", "poets")
+    
+    def test_segment_placeholders_share_files(self):
+        """测试构建提示词时各片段共享已加载的文本数据文件"""
+        text_data = {"poets": ["李白", "杜甫"]}
+        segments = ["({text;poets;poets[0]})", "({text;poets;poets[1]})", "(无占位符)"]
+        
+        with patch("ai.prompt_processor.load_save", return_value=text_data) as mock_load:
+            processed = self.processor._replace_segment_placeholders(segments, {})
+        
+        self.assertEqual(processed, ("(李白)", "(杜甫)", "(无占位符)"))
+        mock_load.assert_called_once_with("text", "poets")
+    
+    def test_iter_placeholders(self):
+        """测试单次扫描找出最外层的成对花括号"""
+        from ai.prompt_processor import _iter_placeholders
+        
+        self.assertEqual(_iter_placeholders("a{b{c}d}e{}"),
+                         [(1, 8, "b{c}d"), (9, 11, "")])
+        # 未闭合的左花括号和多余的右花括号被忽略
+        self.assertEqual(_iter_placeholders("{{x}}}{"), [(0, 5, "{x}")])
+        self.assertEqual(_iter_placeholders("{" * 10000), [])
+    
     def test_build_prompt_single_field(self):
         """测试构建单字段提示词"""
         prompt = self.processor.build_prompt(self.test_segments)
@@ -135,6 +217,25 @@ class PromptProcessorTests(unittest.TestCase):
         self.assertIn("描述一座山", prompt)
         self.assertIn("描述一条河", prompt)
     
+    def test_build_prompt_cache(self):
+        """测试相同片段复用已构建的提示词，更换模板后重新构建"""
+        processor = PromptProcessor()
+        
+        with patch.object(PromptProcessor, "parse_segments", autospec=True,
+                          side_effect=PromptProcessor.parse_segments) as mock_parse:
+            prompt = processor.build_prompt(self.test_segments)
+            self.assertEqual(processor.build_prompt(list(self.test_segments)), prompt)
+            self.assertEqual(mock_parse.call_count, 1)
+            
+            processor.set_template("{json_format}")
+            self.assertNotEqual(processor.build_prompt(self.test_segments), prompt)
+            self.assertEqual(mock_parse.call_count, 2)
+            
+            # 直接给template赋值同样使缓存失效
+            processor.template = "{background}|{json_format}"
+            self.assertTrue(processor.build_prompt(self.test_segments).startswith("(角色是诗人)"))
+            self.assertEqual(mock_parse.call_count, 3)
+    
     def test_custom_template(self):
         """测试自定义模板功能"""
         custom_template = """【角色扮演】你是一位{output_content}专家，请基于以下信息:
@@ -185,6 +286,31 @@ class OutputParserTests(unittest.TestCase):
         self.assertEqual(result["occupation"], "诗人")
         self.assertEqual(result["famous_work"], "将进酒")
     
+    def test_json_parser_bytes(self):
+        """测试直接解析未解码的字节串输出"""
+        parser = JSONOutputParser()
+        result = parser.parse(MOCK_RESPONSES["with_markdown"].encode("utf-8"))
+        
+        self.assertEqual(result["name"], "李白")
+        self.assertEqual(result["famous_work"], "将进酒")
+    
+    def test_json_parser_trailing_text(self):
+        """测试长输出中JSON之后的解释文本被移除"""
+        parser = JSONOutputParser()
+        output = MOCK_RESPONSES["standard_json"] + "\n以上是生成结果。" * 2000
+        
+        self.assertEqual(parser._clean_output(output), MOCK_RESPONSES["standard_json"].strip())
+        self.assertEqual(parser.parse(output)["name"], "李白")
+    
+    def test_json_extract_balanced(self):
+        """测试从说明文字中提取深层嵌套和字符串内含括号的JSON"""
+        parser = JSONOutputParser()
+        nested = '{"a": {"b": {"c": {"d": "}{"}}}}'
+        
+        self.assertEqual(parser._extract_json(f'说明 {{ 未闭合 {nested} 结束'), nested)
+        self.assertEqual(parser._extract_json('结果: [1, [2, "]"]] 完'), '[1, [2, "]"]]')
+        self.assertIsNone(parser._extract_json("{" * 5000))
+    
     def test_json_parser_malformed(self):
         """测试格式错误的JSON解析与修复"""
         parser = JSONOutputParser()
@@ -233,13 +359,34 @@ class OutputParserTests(unittest.TestCase):
         OutputParser.register_parser("csv", CSVOutputParser)
         
         # 测试自定义解析器
-        csv_data = "name,occupation,famous_work\n李白,诗人,将进酒"
-        result = OutputParser.parse(csv_data, parser_type="csv")
+        result = OutputParser.parse(MOCK_RESPONSES["csv"], parser_type="csv")
         
         self.assertEqual(result["name"], "李白")
         self.assertEqual(result["occupation"], "诗人")
         self.assertEqual(result["famous_work"], "将进酒")
     
+    def test_parser_instance_reuse(self):
+        """测试解析器实例复用，重新注册后创建新实例"""
+        parser = OutputParser.get_parser("json")
+        self.assertIs(OutputParser.get_parser("json"), parser)
+        
+        OutputParser.register_parser("json", JSONOutputParser)
+        self.assertIsNot(OutputParser.get_parser("json"), parser)
+        self.assertIsInstance(OutputParser.get_parser("json"), JSONOutputParser)
+    
+    def test_async_parse(self):
+        """测试异步解析，短输出直接解析，长输出放到线程中解析"""
+        long_output = MOCK_RESPONSES["standard_json"] + " " * (64 * 1024)
+        
+        with patch("ai.output_parsers.asyncio.to_thread", wraps=asyncio.to_thread) as mock_thread:
+            result = asyncio.run(OutputParser.async_parse(MOCK_RESPONSES["standard_json"]))
+            self.assertEqual(result["name"], "李白")
+            mock_thread.assert_not_called()
+            
+            result = asyncio.run(OutputParser.async_parse(long_output))
+            self.assertEqual(result["name"], "李白")
+            mock_thread.assert_called_once()
+    
     def test_error_handling(self):
         """测试错误处理能力"""
         # 测试完全无法解析的输入
@@ -252,21 +399,11 @@ class OutputParserTests(unittest.TestCase):
 class APIConnectorTests(unittest.TestCase):
     """测试API连接器功能"""
     
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_api_call_success(self, mock_post):
         """测试成功的API调用"""
         # 模拟成功的API响应
-        mock_response = MagicMock()
-        mock_response.status_code = 200
-        mock_response.json.return_value = {
-            "choices": [
-                {
-                    "message": {
-                        "content": MOCK_RESPONSES["standard_json"]
-                    }
-                }
-            ]
-        }
+        mock_response = _mock_http_response(200, MOCK_API_BODY)
         mock_post.return_value = mock_response
         
         # 创建API连接器并调用
@@ -278,15 +415,14 @@ class APIConnectorTests(unittest.TestCase):
         
         # 验证API调用
         mock_post.assert_called_once()
-        args, kwargs = mock_post.call_args
-        self.assertEqual(kwargs['headers']['Authorization'], f"Bearer {TEST_API_KEY}")
+        self.assertEqual(_sent_payload(mock_post.call_args)['messages'][-1]['content'], "测试提示词")
+        self.assertEqual(connector._session.headers['Authorization'], f"Bearer {TEST_API_KEY}")
     
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_api_call_auth_error(self, mock_post):
         """测试认证错误的API调用"""
         # 模拟认证错误的API响应
-        mock_response = MagicMock()
-        mock_response.status_code = 401
+        mock_response = _mock_http_response(401)
         mock_post.return_value = mock_response
         
         # 创建API连接器并调用，预期抛出AuthenticationError
@@ -294,21 +430,15 @@ class APIConnectorTests(unittest.TestCase):
         with self.assertRaises(AuthenticationError):
             connector.call_api("测试提示词")
     
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_api_call_rate_limit(self, mock_post):
         """测试速率限制的API调用"""
         # 模拟速率限制的API响应
-        mock_response = MagicMock()
-        mock_response.status_code = 429
+        mock_response = _mock_http_response(429)
         mock_post.return_value = mock_response
         
-        # 临时修改重试配置
-        original_max_retries = config.MAX_RETRIES
-        original_retry_delay = config.RETRY_DELAY
-        config.MAX_RETRIES = 2
-        config.RETRY_DELAY = 0.1
-        
-        try:
+        # 临时修改重试配置，退出时自动恢复
+        with patch.object(config, "MAX_RETRIES", 2), patch.object(config, "RETRY_DELAY", 0.1):
             # 创建API连接器并调用，预期抛出RateLimitError
             connector = AIModelConnector(api_key=TEST_API_KEY)
             with self.assertRaises(RateLimitError):
@@ -316,31 +446,241 @@ class APIConnectorTests(unittest.TestCase):
             
             # 验证重试次数
             self.assertEqual(mock_post.call_count, config.MAX_RETRIES + 1)
+    
+    @patch('requests.Session.post')
+    def test_api_call_permanent_error(self, mock_post):
+        """测试不可重试的错误状态立即失败"""
+        error_body = json.dumps({"error": {"message": "参数无效"}}).encode("utf-8")
+        mock_post.return_value = _mock_http_response(400, error_body)
+        
+        connector = AIModelConnector(api_key=TEST_API_KEY)
+        with self.assertRaises(APIError) as context:
+            connector.call_api("测试提示词")
+        
+        self.assertIn("400", str(context.exception))
+        self.assertIn("参数无效", str(context.exception))
+        mock_post.assert_called_once()
+    
+    @patch('requests.Session.post')
+    def test_api_call_total_timeout(self, mock_post):
+        """测试重试等待和单次请求都不超过总时间预算"""
+        mock_post.return_value = _mock_http_response(429)
+        
+        connector = AIModelConnector(api_key=TEST_API_KEY)
+        start = time.monotonic()
+        # 超出预算时抛出最后一次失败的异常，保留错误类型
+        with self.assertRaises(RateLimitError):
+            connector.call_api("测试提示词", total_timeout=0.05)
+        
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertLessEqual(mock_post.call_args.kwargs["timeout"], 0.05)
+    
+    @patch('requests.Session.post')
+    def test_api_call_retry_after_exceeds_budget(self, mock_post):
+        """测试Retry-After超出剩余预算时不等待，直接抛出最后一次失败的异常"""
+        mock_post.return_value = _mock_http_response(429, headers={"Retry-After": "30"})
+        
+        connector = AIModelConnector(api_key=TEST_API_KEY)
+        start = time.monotonic()
+        with self.assertRaises(RateLimitError):
+            connector.call_api("测试提示词", total_timeout=1.5)
+        
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(mock_post.call_count, 1)
+    
+    @unittest.skipIf(importlib.util.find_spec("httpx") is None, "未安装httpx")
+    @patch('httpx.AsyncClient.send', new_callable=AsyncMock)
+    def test_async_retry_after_exceeds_budget(self, mock_post):
+        """测试异步调用在Retry-After超出剩余预算时直接抛出异常"""
+        mock_post.return_value = _mock_http_response(429, headers={"Retry-After": "30"})
+        
+        connector = AIModelConnector(api_key=TEST_API_KEY)
+        
+        async def run_call():
+            try:
+                return await connector.acall_api("测试提示词", total_timeout=1.5)
+            finally:
+                await connector.aclose()
+        
+        start = time.monotonic()
+        with self.assertRaises(RateLimitError):
+            asyncio.run(run_call())
+        
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(mock_post.call_count, 1)
+    
+    @patch('requests.Session.post')
+    def test_api_call_nan_in_body(self, mock_post):
+        """测试响应体中含有NaN时与标准库json的解析结果一致"""
+        body = b'{"choices": [{"message": {"content": "ok"}}], "usage": {"cost": NaN}}'
+        mock_post.return_value = _mock_http_response(200, body)
+        
+        connector = AIModelConnector(api_key=TEST_API_KEY)
+        self.assertEqual(connector.call_api("测试提示词"), "ok")
+    
+    @patch('requests.Session.post')
+    def test_response_cache(self, mock_post):
+        """测试低温度调用的响应缓存"""
+        mock_response = _mock_http_response(200, MOCK_API_BODY)
+        mock_post.return_value = mock_response
+        
+        AIModelConnector.clear_cache()
+        try:
+            connector = AIModelConnector(api_key=TEST_API_KEY)
+            
+            # 相同的低温度调用只请求一次
+            self.assertEqual(connector.call_api("测试提示词", temperature=0), MOCK_RESPONSES["standard_json"])
+            self.assertEqual(connector.call_api("测试提示词", temperature=0), MOCK_RESPONSES["standard_json"])
+            self.assertEqual(mock_post.call_count, 1)
+            
+            # 默认温度的调用不缓存
+            connector.call_api("测试提示词")
+            connector.call_api("测试提示词")
+            self.assertEqual(mock_post.call_count, 3)
+            
+            # 未指定温度值（None）的调用不缓存
+            connector.call_api("测试提示词", temperature=None)
+            self.assertEqual(mock_post.call_count, 4)
         finally:
-            # 恢复原始配置
-            config.MAX_RETRIES = original_max_retries
-            config.RETRY_DELAY = original_retry_delay
+            AIModelConnector.clear_cache()
+    
+    @patch('requests.Session.post')
+    def test_stream_api(self, mock_post):
+        """测试流式调用逐块返回文本"""
+        mock_response = _mock_http_response(200)
+        mock_response.iter_lines.return_value = [
+            b'data: {"choices": [{"delta": {"content": "{\\"name\\": "}}]}',
+            b'',
+            'data: {"choices": [{"delta": {"content": "\\"李白\\"}"}}]}'.encode("utf-8"),
+            b'data: [DONE]'
+        ]
+        mock_post.return_value = mock_response
+        
+        connector = AIModelConnector(api_key=TEST_API_KEY)
+        chunks = list(connector.stream_api("测试提示词"))
+        
+        self.assertEqual(chunks, ['{"name": ', '"李白"}'])
+        self.assertTrue(_sent_payload(mock_post.call_args)['stream'])
+        
+        # 异步调用不支持流式响应
+        with self.assertRaises(ValueError):
+            asyncio.run(connector.acall_api("测试提示词", stream=True))
+    
+    @patch('requests.Session.post')
+    def test_large_response_extract(self, mock_post):
+        """测试较大响应的回复文本提取"""
+        long_content = json.dumps({"story": "很长的故事" * 2000}, ensure_ascii=False)
+        body = json.dumps({
+            "id": "chatcmpl-test",
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": long_content}}],
+            "usage": {"total_tokens": 4000}
+        }).encode("utf-8")
+        mock_post.return_value = _mock_http_response(200, body)
+        
+        connector = AIModelConnector(api_key=TEST_API_KEY)
+        self.assertEqual(connector.call_api("测试提示词"), long_content)
+    
+    @patch('requests.Session.post')
+    def test_oversized_response(self, mock_post):
+        """测试超出大小限制的响应被中止"""
+        mock_response = _mock_http_response(200, b"x" * 64)
+        mock_post.return_value = mock_response
+        
+        connector = AIModelConnector(api_key=TEST_API_KEY)
+        with patch.object(config, "MAX_RESPONSE_BYTES", 32):
+            with self.assertRaises(APIError):
+                connector.call_api("测试提示词")
+        mock_response.close.assert_called_once()
+        
+        # 无效的Content-Length同样作为APIError抛出
+        mock_post.return_value = _mock_http_response(200, b"{}", {"Content-Length": "abc"})
+        with self.assertRaises(APIError):
+            connector.call_api("测试提示词")
+    
+    def test_backoff_delay(self):
+        """测试重试退避时间计算"""
+        connector = AIModelConnector(api_key=TEST_API_KEY)
+        
+        # 优先使用服务端返回的Retry-After
+        self.assertEqual(connector._backoff_delay(0, {"Retry-After": "3"}), 3.0)
+        
+        # 指数退避并带有随机抖动
+        for retries in range(3):
+            base = min(config.RETRY_MAX_DELAY, config.RETRY_DELAY * (2 ** retries))
+            delay = connector._backoff_delay(retries)
+            self.assertGreaterEqual(delay, base * 0.5)
+            self.assertLessEqual(delay, base * 1.5)
+    
+    @unittest.skipIf(importlib.util.find_spec("httpx") is None, "未安装httpx")
+    @patch('httpx.AsyncClient.send', new_callable=AsyncMock)
+    def test_async_batch_call(self, mock_post):
+        """测试异步并发API调用"""
+        mock_response = _mock_http_response(200, MOCK_API_BODY)
+        mock_post.return_value = mock_response
+        
+        connector = AIModelConnector(api_key=TEST_API_KEY)
+        
+        async def run_batch():
+            try:
+                return await connector.abatch(["提示词1", "提示词2", "提示词3"])
+            finally:
+                await connector.aclose()
+        
+        results = asyncio.run(run_batch())
+        
+        # 验证结果顺序与数量
+        self.assertEqual(results, [MOCK_RESPONSES["standard_json"]] * 3)
+        self.assertEqual(mock_post.call_count, 3)
+    
+    @unittest.skipIf(importlib.util.find_spec("httpx") is None, "未安装httpx")
+    @patch('httpx.AsyncClient.send', new_callable=AsyncMock)
+    def test_call_api_many(self, mock_post):
+        """测试分批并发API调用"""
+        mock_response = _mock_http_response(200, MOCK_API_BODY)
+        mock_post.return_value = mock_response
+        
+        connector = AIModelConnector(api_key=TEST_API_KEY)
+        results = connector.call_api_many([f"提示词{i}" for i in range(5)], batch_size=2)
+        
+        self.assertEqual(results, [MOCK_RESPONSES["standard_json"]] * 5)
+        self.assertEqual(mock_post.call_count, 5)
+    
+    @unittest.skipIf(importlib.util.find_spec("httpx") is None, "未安装httpx")
+    def test_async_concurrency_limit(self):
+        """测试异步调用的并发数不超过MAX_CONCURRENCY"""
+        active = 0
+        peak = 0
+        
+        async def fake_send(request, stream=False):
+            nonlocal active, peak
+            active += 1
+            peak = max(peak, active)
+            await asyncio.sleep(0.01)
+            active -= 1
+            return _mock_http_response(200, MOCK_API_BODY)
+        
+        connector = AIModelConnector(api_key=TEST_API_KEY)
+        with patch('httpx.AsyncClient.send', side_effect=fake_send), \
+             patch.object(config, "MAX_CONCURRENCY", 2):
+            results = connector.call_api_many([f"提示词{i}" for i in range(6)], batch_size=6)
+        
+        self.assertEqual(len(results), 6)
+        self.assertEqual(peak, 2)
     
     def test_missing_api_key(self):
         """测试缺少API密钥的情况"""
-        # 临时保存原始API密钥
-        original_api_key = config.DEEPSEEK_API_KEY
-        config.DEEPSEEK_API_KEY = ""
-        
-        try:
+        # 临时清空API密钥，退出时自动恢复
+        with patch.object(config, "DEEPSEEK_API_KEY", ""):
             # 尝试创建未指定API密钥的连接器
             with self.assertRaises(AuthenticationError):
                 AIModelConnector()
-        finally:
-            # 恢复原始API密钥
-            config.DEEPSEEK_API_KEY = original_api_key
 
 class IntegrationTests(unittest.TestCase):
     """集成测试"""
     
     def setUp(self):
         """测试前的设置"""
-        self.processor = PromptProcessor()
+        self.processor = _DEFAULT_PROCESSOR
         self.test_segments = [
             "(主题是季节)",
             "<描述春天的特点>",
@@ -416,14 +756,8 @@ class CustomOutputParserTests(unittest.TestCase):
                 return result
         
         # 测试XML解析器
-        xml_data = """
-        <name>李白</name>
-        <occupation>诗人</occupation>
-        <famous_work>将进酒</famous_work>
-        """
-        
         parser = XMLOutputParser()
-        result = parser.parse(xml_data)
+        result = parser.parse(MOCK_RESPONSES["xml"])
         
         self.assertEqual(result["name"], "李白")
         self.assertEqual(result["occupation"], "诗人")
@@ -431,7 +765,7 @@ class CustomOutputParserTests(unittest.TestCase):
         
         # 注册并通过工厂使用
         OutputParser.register_parser("xml", XMLOutputParser)
-        result2 = OutputParser.parse(xml_data, parser_type="xml")
+        result2 = OutputParser.parse(MOCK_RESPONSES["xml"], parser_type="xml")
         
         self.assertEqual(result2["name"], "李白")
 